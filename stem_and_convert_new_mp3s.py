@@ -1,184 +1,475 @@
+import concurrent.futures
+import functools
+import json
+import logging
+import multiprocessing
 import os
-import subprocess
-from pathlib import Path
-import shutil
+import queue
+import threading
+import numpy as np
 import torch
 from demucs.pretrained import get_model
 from demucs.apply import apply_model
-from demucs.audio import AudioFile, save_audio
-from midiutil import MIDIFile
+from demucs.audio import AudioFile, convert_audio
+from basic_pitch.inference import Model, unwrap_output, window_audio_file
+from basic_pitch.constants import AUDIO_SAMPLE_RATE, AUDIO_N_SAMPLES, FFT_HOP
+from basic_pitch import ICASSP_2022_MODEL_PATH, note_creation
 import mido
 
-def get_output_path(input_path, stem_name=None):
-    """Convert input path to expected output path."""
-    # Get the filename without extension
-    base_name = os.path.splitext(os.path.basename(input_path))[0]
+# orjson parses and serializes several times faster than the stdlib; fall
+# back silently since the cache is small enough for json to handle
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+def configure_logging():
+    """Set up console logging once; also used as the process-pool worker
+    initializer so log records from workers are not silently dropped.
+
+    force=True because the ML libraries configure the root logger as a side
+    effect of their import-time warnings, which would make a plain
+    basicConfig a silent no-op."""
+    logging.basicConfig(level=logging.INFO, format='%(message)s', force=True)
+
+# Cache of source-file mtimes from the last run, used to skip untouched
+# files without re-statting every expected output
+CACHE_FILE = '.mp3_cache.json'
+
+def load_cache():
+    """Load the mtime cache from the previous run, if any."""
+    try:
+        with open(CACHE_FILE, 'rb') as f:
+            data = f.read()
+        return orjson.loads(data) if orjson else json.loads(data)
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(cache):
+    """Persist the mtime cache atomically so a crash can't corrupt it."""
+    tmp_path = CACHE_FILE + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(orjson.dumps(cache) if orjson else json.dumps(cache).encode())
+    os.replace(tmp_path, CACHE_FILE)
+
+def song_base_name(input_path):
+    """Filename without directory or extension, shared by all of a song's outputs."""
+    return os.path.splitext(os.path.basename(input_path))[0]
+
+def get_output_path(base_name, stem_name=None):
+    """Build the expected output path from a precomputed song base name.
+
+    Callers split the input path once with song_base_name instead of
+    re-splitting it for every stem.
+    """
     # Create the output path with _basic_pitch.mid extension
     if stem_name:
         return os.path.join('out', f"{base_name}_{stem_name}_basic_pitch.mid")
     return os.path.join('out', f"{base_name}_basic_pitch.mid")
 
 def combine_midi_files(midi_files, output_path):
-    """Combine multiple MIDI files into one, preserving their tracks."""
-    # Create a new MIDI file
-    combined = MIDIFile()
-    
-    # Track mapping for different instruments using standard MIDI channels
-    track_mapping = {
+    """Combine multiple MIDI files into one, preserving their tracks.
+
+    Each stem's messages are copied verbatim onto its own track with the
+    channel remapped, so note timing comes straight from the source files
+    instead of being re-synthesized.
+    """
+    # Channel mapping for different instruments using standard MIDI channels
+    channel_mapping = {
         'drums': 9,     # Channel 10 (0-based) is standard for drums
         'bass': 0,      # Channel 1 for bass
         'vocals': 1,    # Channel 2 for vocals
         'other': 2      # Channel 3 for other instruments
     }
-    
+    # Program (instrument) per stem; drums need none on channel 10
+    program_mapping = {
+        'bass': 33,     # Electric Bass
+        'vocals': 53,   # Voice Oohs
+        'other': 0      # Acoustic Grand Piano
+    }
+
+    combined = mido.MidiFile()
+
     # Process each MIDI file
     for stem_name, midi_path in midi_files.items():
         if not os.path.exists(midi_path):
-            print(f"Warning: MIDI file {midi_path} not found, skipping...")
+            logger.warning(f"MIDI file {midi_path} not found, skipping...")
             continue
-            
+
         # Read the MIDI file
         mid = mido.MidiFile(midi_path)
-        
-        # Add a new track for this stem
-        track = track_mapping.get(stem_name, len(track_mapping))
-        combined.addTrackName(track, 0, stem_name)
-        
-        # Set program (instrument) for each track
-        if stem_name == 'drums':
-            # Drums don't need a program change as they use channel 10
-            pass
-        elif stem_name == 'bass':
-            combined.addProgramChange(track, 0, 0, 33)  # Electric Bass
-        elif stem_name == 'vocals':
-            combined.addProgramChange(track, 0, 0, 53)  # Voice Oohs
-        else:  # other
-            combined.addProgramChange(track, 0, 0, 0)   # Acoustic Grand Piano
-        
-        # Copy all messages from the original file
-        for msg in mid.tracks[0]:
-            if msg.type == 'note_on' or msg.type == 'note_off':
-                # Convert the message to the format MIDIUtil expects
-                if msg.type == 'note_on':
-                    combined.addNote(track, 0, msg.note, msg.time, msg.time + 100, msg.velocity)
-                # Note-off messages are handled automatically by MIDIUtil
-    
+        combined.ticks_per_beat = mid.ticks_per_beat
+
+        # Build a new track for this stem
+        channel = channel_mapping.get(stem_name, len(channel_mapping))
+        track = mido.MidiTrack()
+        track.append(mido.MetaMessage('track_name', name=stem_name, time=0))
+        if stem_name in program_mapping:
+            track.append(mido.Message('program_change', channel=channel,
+                                      program=program_mapping[stem_name], time=0))
+
+        # Copy the channel messages as-is, remapped onto this stem's channel.
+        # Meta messages and the source's own program changes are dropped, but
+        # their delta times are carried so timing is preserved.
+        carry = 0
+        for msg in mido.merge_tracks(mid.tracks):
+            if msg.is_meta or msg.type == 'program_change' or not hasattr(msg, 'channel'):
+                carry += msg.time
+                continue
+            track.append(msg.copy(channel=channel, time=msg.time + carry))
+            carry = 0
+
+        combined.tracks.append(track)
+
     # Write the combined file
-    with open(output_path, 'wb') as f:
-        combined.writeFile(f)
-    
-    print(f"Combined MIDI file saved to: {output_path}")
-    print("MIDI channels used:")
-    print("- Drums: Channel 10 (standard MIDI drum channel)")
-    print("- Bass: Channel 1")
-    print("- Vocals: Channel 2")
-    print("- Other: Channel 3")
+    combined.save(output_path)
 
-def separate_stems(input_path):
-    """Separate audio into stems using Demucs."""
-    # Initialize the model (using the 4-stem model)
+    logger.info(f"Combined MIDI file saved to: {output_path}")
+    logger.info("MIDI channels used:")
+    logger.info("- Drums: Channel 10 (standard MIDI drum channel)")
+    logger.info("- Bass: Channel 1")
+    logger.info("- Vocals: Channel 2")
+    logger.info("- Other: Channel 3")
+
+def pick_device():
+    """Pick the fastest available device for inference."""
+    if torch.cuda.is_available():
+        return 'cuda'
+    if torch.backends.mps.is_available():
+        return 'mps'
+    return 'cpu'
+
+def audio_to_midi(audio, model):
+    """Convert an in-memory mono audio array (at basic-pitch's sample rate)
+    to MIDI data, mirroring basic_pitch.inference.predict without the
+    file round-trip."""
+    n_overlapping_frames = 30
+    overlap_len = n_overlapping_frames * FFT_HOP
+    hop_size = AUDIO_N_SAMPLES - overlap_len
+    original_length = audio.shape[0]
+
+    # Window the signal the same way basic-pitch does for files
+    padded = np.concatenate([np.zeros(overlap_len // 2, dtype=np.float32), audio])
+    output = {'note': [], 'onset': [], 'contour': []}
+    for window, _ in window_audio_file(padded, hop_size):
+        for k, v in model.predict(np.expand_dims(window, axis=0)).items():
+            output[k].append(v)
+    model_output = {
+        k: unwrap_output(np.concatenate(v), original_length, n_overlapping_frames)
+        for k, v in output.items()
+    }
+
+    # Same post-processing defaults as basic_pitch.inference.predict
+    min_note_len = int(np.round(127.70 / 1000 * (AUDIO_SAMPLE_RATE / FFT_HOP)))
+    midi_data, _ = note_creation.model_output_to_notes(
+        model_output,
+        onset_thresh=0.5,
+        frame_thresh=0.3,
+        min_note_len=min_note_len,
+        min_freq=None,
+        max_freq=None,
+        melodia_trick=True,
+        midi_tempo=120,
+    )
+    return midi_data
+
+@functools.lru_cache(maxsize=1)
+def get_cached_model():
+    """Load the Demucs model once and keep it resident for the whole batch.
+
+    Deserializing the weights costs several seconds per call, so reloading
+    for every song dominates short batch runs.
+    """
     model = get_model('htdemucs')
-    model.cpu()  # Use CPU for inference
-    
-    # Create a temporary directory for stems
-    temp_dir = os.path.join('out', 'temp_stems')
-    os.makedirs(temp_dir, exist_ok=True)
-    
+    model.eval()
+    device = pick_device()
+    model.to(device)
+
+    if device == 'cpu':
+        # Quantize the big matmuls to int8 for CPU inference; htdemucs is
+        # memory-bound at long segments, so halving weight bandwidth on the
+        # Linear/LSTM layers matters more than the FLOP savings
+        try:
+            model = torch.quantization.quantize_dynamic(
+                model, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8)
+        except Exception as e:
+            logger.warning(f"dynamic quantization unavailable, running FP32: {e}")
+    elif device == 'cuda':
+        # Compile the forwards in place (rather than wrapping the modules)
+        # so apply_model's isinstance checks still see the demucs classes.
+        # Kernel fusion and CUDA graphs shave eager dispatch overhead off
+        # every segment; on CPU the compile latency would swamp the win.
+        try:
+            submodels = model.models if hasattr(model, 'models') else [model]
+            for sub in submodels:
+                sub.forward = torch.compile(sub.forward, mode='reduce-overhead', fullgraph=False)
+            # Warm the compile once so the first real song doesn't pay for
+            # it, under the same autocast state as the real inference -
+            # dynamo guards on autocast, so fp32 warm-up graphs would just
+            # be recompiled on the first song
+            with torch.inference_mode(), torch.autocast(device_type=device, dtype=torch.float16):
+                apply_model(model, torch.zeros(1, model.audio_channels,
+                                               model.samplerate * 8, device=device))
+        except Exception as e:
+            logger.warning(f"torch.compile unavailable, running eager: {e}")
+            # Drop any instance-level compiled forwards so we really are eager
+            for sub in submodels:
+                vars(sub).pop('forward', None)
+
+    return model
+
+@functools.lru_cache(maxsize=1)
+def get_cached_bp_model():
+    """Load the basic-pitch model once and reuse it for every stem and song."""
+    return Model(ICASSP_2022_MODEL_PATH)
+
+def separate_stems(input_path):
+    """Separate audio into stems using Demucs.
+
+    The source is decoded by FFmpeg exactly once, here; the stems are
+    resampled in memory and returned as a dict mapping stem name to a mono
+    float32 numpy array at basic-pitch's sample rate, so nothing downstream
+    re-reads or re-decodes audio from disk.
+    """
+    # The model is cached across calls (and already on the right device)
+    model = get_cached_model()
+    device = pick_device()
+
     # Load and process the audio
     wav = AudioFile(input_path).read(streams=0, samplerate=model.samplerate, channels=model.audio_channels)
+    # Normalize in place with Python scalars: avoids allocating full-size
+    # intermediates, which halves peak memory on this purely memory-bound step
     ref = wav.mean(0)
-    wav = (wav - ref.mean()) / ref.std()
-    
-    # Apply the model
-    sources = apply_model(model, wav[None])[0]
-    sources = sources * ref.std() + ref.mean()
-    
-    # Get the base name of the input file
-    base_name = os.path.splitext(os.path.basename(input_path))[0]
-    stems_dir = os.path.join(temp_dir, base_name)
-    os.makedirs(stems_dir, exist_ok=True)
-    
-    # Save each stem
-    stem_paths = {}
-    for source, name in zip(sources, model.sources):
-        stem_path = os.path.join(stems_dir, f"{name}.wav")
-        save_audio(source, stem_path, model.samplerate)
-        stem_paths[name] = stem_path
-    
-    return stem_paths
+    mean = ref.mean().item()
+    std = ref.std().item()
+    wav.sub_(mean).div_(std)
+    wav = wav.to(device)
+
+    # Apply the model in fixed-length segments so memory stays constant no
+    # matter how long the track is (FP16 autocast on GPU, with a retry on
+    # half-size segments if we still run out of VRAM)
+    segment = getattr(model, 'segment', 7.8)
+    try:
+        with torch.inference_mode(), torch.autocast(device_type=device, dtype=torch.float16, enabled=(device != 'cpu')):
+            sources = apply_model(model, wav[None], split=True, overlap=0.1,
+                                  segment=segment, num_workers=2, device=device)[0]
+    except torch.cuda.OutOfMemoryError:
+        logger.warning("CUDA out of memory, retrying with smaller segments...")
+        torch.cuda.empty_cache()
+        with torch.inference_mode(), torch.autocast(device_type=device, dtype=torch.float16, enabled=(device != 'cpu')):
+            sources = apply_model(model, wav[None], split=True, overlap=0.1,
+                                  segment=segment / 2, num_workers=2, device=device)[0]
+    # Denormalize in place, then downmix and resample to basic-pitch's mono
+    # sample rate while the stems are still on the device, so the transfer
+    # to the host moves a quarter of the bytes (all inside inference mode,
+    # since the output of apply_model is an inference tensor)
+    with torch.inference_mode():
+        sources.mul_(std).add_(mean)
+        sources = convert_audio(sources, model.samplerate, AUDIO_SAMPLE_RATE, 1)
+        sources = sources.cpu()
+
+    return {name: source.squeeze(0).numpy()
+            for source, name in zip(sources, model.sources)}
+
+def convert_stems_to_midi(mp3_path, stems, combine_midi=True):
+    """Convert a song's separated stems to MIDI and optionally combine them.
+
+    Returns True on success.
+    """
+    base_name = song_base_name(mp3_path)
+    try:
+        # Convert the stems straight from memory with the batch-resident
+        # basic-pitch model. The four stems are independent and ONNX Runtime
+        # releases the GIL during inference, so run them on a small thread
+        # pool.
+        logger.info(f"Converting stems to MIDI: {', '.join(stems)}")
+        bp_model = get_cached_bp_model()
+        midi_files = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(stems)) as executor:
+            futures = {
+                stem_name: executor.submit(audio_to_midi, audio, bp_model)
+                for stem_name, audio in stems.items()
+            }
+        # Collect in stem order so the combined file's track layout is stable
+        for stem_name, future in futures.items():
+            output_path = get_output_path(base_name, stem_name)
+            future.result().write(output_path)
+            midi_files[stem_name] = output_path
+            logger.info(f"Successfully converted {stem_name} stem")
+
+        # Combine MIDI files if requested
+        if combine_midi:
+            combined_path = os.path.join('out', f"{base_name}_combined.mid")
+            logger.info("Combining MIDI files...")
+            combine_midi_files(midi_files, combined_path)
+
+        return True
+
+    except Exception as e:
+        logger.error(f"Error processing {mp3_path}: {str(e)}")
+        return False
+
+def process_single_mp3(mp3_path, combine_midi=True):
+    """Run the full pipeline (stem separation -> MIDI -> combine) for one MP3 file.
+
+    Kept at module level so it is picklable for the process pool.
+    """
+    logger.info(f"Processing: {mp3_path}")
+    try:
+        logger.info(f"Separating stems for: {mp3_path}")
+        stems = separate_stems(mp3_path)
+    except Exception as e:
+        logger.error(f"Error processing {mp3_path}: {str(e)}")
+        return False
+    return convert_stems_to_midi(mp3_path, stems, combine_midi)
+
+def process_files_pipelined(files_to_process, combine_midi=True):
+    """Process files with stem separation and MIDI conversion overlapped.
+
+    The two stages stress different resources (demucs the GPU or torch's
+    CPU threads, basic-pitch the ONNX runtime), so a producer thread
+    separates file N+1 while the main thread converts file N's stems.
+    Returns a dict mapping each path to success.
+    """
+    # Bound the in-flight stems to cap memory held by the pipeline
+    stems_queue = queue.Queue(maxsize=2)
+    stop = threading.Event()
+
+    def separate_worker():
+        for mp3_path in files_to_process:
+            if stop.is_set():
+                break
+            logger.info(f"Processing: {mp3_path}")
+            try:
+                logger.info(f"Separating stems for: {mp3_path}")
+                stems = separate_stems(mp3_path)
+            except Exception as e:
+                logger.error(f"Error processing {mp3_path}: {str(e)}")
+                stems = None
+            # Keep checking for a stop while waiting for queue space, so a
+            # consumer that died (e.g. Ctrl-C) can't strand us in put
+            while not stop.is_set():
+                try:
+                    stems_queue.put((mp3_path, stems), timeout=1)
+                    break
+                except queue.Full:
+                    pass
+
+    separator = threading.Thread(target=separate_worker, daemon=True)
+    separator.start()
+
+    results = {}
+    try:
+        for _ in files_to_process:
+            mp3_path, stems = stems_queue.get()
+            if stems is None:
+                results[mp3_path] = False
+            else:
+                results[mp3_path] = convert_stems_to_midi(mp3_path, stems, combine_midi)
+    finally:
+        # On an abnormal exit, tell the producer to wind down after its
+        # current file instead of grinding through the rest of the batch;
+        # on a normal one the flag is moot and this is a plain join
+        stop.set()
+        separator.join()
+    return results
 
 def process_new_mp3s(combine_midi=True):
     # Create out directory if it doesn't exist
     os.makedirs('out', exist_ok=True)
     
-    # Get all MP3 files from data directory
-    data_dir = Path('data')
-    mp3_files = list(data_dir.glob('*.mp3'))
-    
+    # Get all MP3 files from data directory; scandir hands back name, path
+    # and a cached stat without allocating a Path object per entry
+    try:
+        mp3_files = [entry for entry in os.scandir('data')
+                     if entry.is_file() and entry.name.endswith('.mp3')]
+    except FileNotFoundError:
+        mp3_files = []
+
     if not mp3_files:
-        print("No MP3 files found in data/ directory")
+        logger.info("No MP3 files found in data/ directory")
         return
     
-    # Track which files need processing
+    # Read the output directory once instead of stat-ing every expected
+    # file; membership checks are then O(1)
+    existing = {entry.name for entry in os.scandir('out') if entry.is_file()}
+
+    # mtimes recorded by the last run; a file whose mtime is unchanged and
+    # whose outputs still exist can be skipped without further inspection
+    cache = load_cache()
+
+    # Track which files need processing, and their current mtimes so the
+    # cache can be updated for the ones that succeed
     files_to_process = []
-    
+    mtimes = {}
+
     # Check each MP3 file
-    for mp3_path in mp3_files:
-        # Check if any of the stem MIDI files don't exist
-        needs_processing = False
-        for stem in ['drums', 'bass', 'vocals', 'other']:
-            output_path = get_output_path(mp3_path, stem)
-            if not os.path.exists(output_path):
-                needs_processing = True
-                break
-        
+    for entry in mp3_files:
+        mp3_path = entry.path
+        base_name = song_base_name(entry.name)  # split once, not per stem
+        key = os.path.abspath(mp3_path)
+        mtime = entry.stat().st_mtime_ns  # stat is cached on the DirEntry
+
+        # Reprocess if the source changed since the last run; a file the
+        # cache doesn't know yet is just unknown, not changed, so for it we
+        # rely on the output check below alone
+        cached = cache.get(key)
+        needs_processing = cached is not None and cached != mtime
+        if not needs_processing:
+            # ...or if any of the stem MIDI files are missing
+            for stem in ['drums', 'bass', 'vocals', 'other']:
+                output_name = os.path.basename(get_output_path(base_name, stem))
+                if output_name not in existing:
+                    needs_processing = True
+                    break
+
         if needs_processing:
-            files_to_process.append(str(mp3_path))
+            files_to_process.append(mp3_path)
+            mtimes[mp3_path] = (key, mtime)
+        elif cached is None:
+            # Outputs are complete but the file is new to the cache;
+            # backfill the entry so later runs can skip on the mtime alone
+            cache[key] = mtime
     
     if not files_to_process:
-        print("No new MP3 files to process")
+        logger.info("No new MP3 files to process")
+        save_cache(cache)  # persist any backfilled entries
         return
     
     # Process new files
-    print(f"Found {len(files_to_process)} new MP3 files to process")
-    for mp3_path in files_to_process:
-        print(f"Processing: {mp3_path}")
-        try:
-            # First separate the stems
-            print(f"Separating stems for: {mp3_path}")
-            stems = separate_stems(mp3_path)
-            
-            # Process each stem
-            midi_files = {}
-            for stem_name, stem_path in stems.items():
-                print(f"Converting {stem_name} stem to MIDI")
-                output_path = get_output_path(mp3_path, stem_name)
-                midi_files[stem_name] = output_path
-                
-                # Use subprocess to call basic-pitch command
-                result = subprocess.run(['basic-pitch', 'out', stem_path], 
-                                     capture_output=True, 
-                                     text=True)
-                
-                if result.returncode == 0:
-                    print(f"Successfully converted {stem_name} stem")
-                else:
-                    print(f"Error processing {stem_name} stem: {result.stderr}")
-            
-            # Combine MIDI files if requested
-            if combine_midi:
-                base_name = os.path.splitext(os.path.basename(mp3_path))[0]
-                combined_path = os.path.join('out', f"{base_name}_combined.mid")
-                print("Combining MIDI files...")
-                combine_midi_files(midi_files, combined_path)
-            
-            # Clean up temporary stem files
-            temp_dir = os.path.join('out', 'temp_stems')
-            if os.path.exists(temp_dir):
-                shutil.rmtree(temp_dir)
-                
-        except Exception as e:
-            print(f"Error processing {mp3_path}: {str(e)}")
+    logger.info(f"Found {len(files_to_process)} new MP3 files to process")
+
+    # One demucs job already saturates a GPU; on CPU, demucs is itself
+    # multithreaded, so leave it a few cores per worker
+    if pick_device() == 'cpu':
+        max_workers = max(1, (os.cpu_count() or 1) // 4)
+    else:
+        max_workers = 1
+    max_workers = min(max_workers, len(files_to_process))
+
+    if max_workers == 1:
+        # Single worker: still overlap separation with MIDI conversion
+        results = process_files_pipelined(files_to_process, combine_midi)
+    else:
+        # Spawn (rather than fork) to keep CUDA and the ML runtimes happy in workers
+        mp_context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+                                                    mp_context=mp_context,
+                                                    initializer=configure_logging) as executor:
+            futures = {mp3_path: executor.submit(process_single_mp3, mp3_path, combine_midi)
+                       for mp3_path in files_to_process}
+        # errors are caught and reported inside the worker
+        results = {mp3_path: future.result() for mp3_path, future in futures.items()}
+
+    # Remember the mtimes of everything that processed cleanly
+    for mp3_path, ok in results.items():
+        if ok:
+            key, mtime = mtimes[mp3_path]
+            cache[key] = mtime
+    save_cache(cache)
 
 if __name__ == "__main__":
+    configure_logging()
     process_new_mp3s(combine_midi=True)  # Set to False if you don't want to combine MIDI files
\ No newline at end of file